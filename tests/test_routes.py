@@ -4,11 +4,24 @@ Account API Service Test Suite
 Test cases can be run with the following:
   nosetests -v --with-spec --spec-color
   coverage report -m
+
+Set TEST_FAST=1 to use an in-memory SQLite database instead of Postgres.
+
+They can also be spread across CPUs with pytest-xdist:
+  pytest -n auto --dist loadfile
+
+Each worker gets its own Postgres schema (see tests/__init__.py), which
+every test module on that worker shares. --dist loadfile keeps each module
+on a single worker so test_models.py and these tests never interleave.
 """
 import os
 import logging
 from unittest import TestCase
-from tests.factories import AccountFactory
+from flask.testing import FlaskClient
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
 from service.common import status  # HTTP Status Codes
 from service.models import db, Account, init_db
 from service.routes import app
@@ -19,8 +32,80 @@ DATABASE_URI = os.getenv(
 )
 
 BASE_URL = "/accounts"
+SAMPLE_SIZE = 20
 HTTPS_ENVIRON = {'wsgi.url_scheme': 'https'}
 
+# a valid request body for tests that never store the account
+SAMPLE_PAYLOAD = {
+    "name": "Jane Doe",
+    "email": "jane.doe@example.com",
+    "address": "123 Main Street",
+    "phone_number": "555-0100",
+    "date_joined": "2020-01-01",
+}
+
+
+class JsonClient(FlaskClient):
+    """Test client that sends JSON unless told otherwise"""
+
+    def open(self, *args, **kwargs):
+        """Defaults the Content-Type of every request to application/json"""
+        if (args and isinstance(args[0], str)) or "path" in kwargs:
+            kwargs.setdefault("content_type", "application/json")
+        return super().open(*args, **kwargs)
+
+
+def _sqlite_begin(conn):
+    """Emits the BEGIN that pysqlite skips so SAVEPOINTs behave"""
+    conn.exec_driver_sql("BEGIN")
+
+
+######################################################################
+#  M O D U L E   F I X T U R E S
+######################################################################
+def setUpModule():  # pylint: disable=invalid-name
+    """Runs once before all of the tests in this module"""
+    talisman.force_https = False
+
+    app.config["TESTING"] = True
+    app.config["DEBUG"] = False
+    app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+    app.logger.setLevel(logging.CRITICAL)
+    # drop log records before they are created, route logs included;
+    # tearDownModule turns logging back on for later suites
+    logging.disable(logging.CRITICAL)
+    if DATABASE_URI.startswith("postgresql"):
+        # keep a small pool so every test reuses the same physical connection
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "pool_size": 2,
+            "max_overflow": 0,
+            "pool_pre_ping": False,
+        }
+    elif DATABASE_URI.startswith("sqlite"):
+        # share one connection so the in-memory database outlives each session,
+        # and leave transaction control to SQLAlchemy instead of pysqlite
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            "connect_args": {"check_same_thread": False, "isolation_level": None},
+            "poolclass": StaticPool,
+        }
+    init_db(app)
+    if DATABASE_URI.startswith("sqlite"):
+        event.listen(db.engine, "begin", _sqlite_begin)
+
+    # clean up anything left behind by other test suites
+    try:
+        db.session.execute(text("TRUNCATE TABLE account RESTART IDENTITY CASCADE"))
+    except OperationalError:
+        # SQLite has no TRUNCATE so fall back to a plain DELETE
+        db.session.rollback()
+        db.session.query(Account).delete()
+    db.session.commit()
+
+
+def tearDownModule():  # pylint: disable=invalid-name
+    """Runs once after all of the tests in this module"""
+    logging.disable(logging.NOTSET)
+
 
 ######################################################################
 #  T E S T   C A S E S
@@ -31,49 +116,90 @@ class TestAccountService(TestCase):
     @classmethod
     def setUpClass(cls):
         """Run once before all tests"""
-        talisman.force_https = False
-
-        app.config["TESTING"] = True
-        app.config["DEBUG"] = False
-        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
-        app.logger.setLevel(logging.CRITICAL)
-        init_db(app)
+        cls.session = db.session
+        # the service is stateless, so a shared client has no cookies to keep
+        cls.client = JsonClient(app, app.response_class, use_cookies=False)
+        cls.sample_accounts = None
 
     @classmethod
     def tearDownClass(cls):
-        """Runs once before test suite"""
+        """Runs once after test suite"""
+        db.session = cls.session
 
     def setUp(self):
         """Runs before each test"""
-        db.session.query(Account).delete()  # clean up the last tests
-        db.session.commit()
-
-        self.client = app.test_client()
+        # join the session into an external transaction that is rolled
+        # back in tearDown so nothing a test writes is ever committed
+        self.connection = db.engine.connect()
+        self.trans = self.connection.begin()
+        db.session = scoped_session(sessionmaker(bind=self.connection))
+        db.session.begin_nested()
 
     def tearDown(self):
         """Runs once after each test case"""
-        db.session.remove()
+        # the session is rebuilt in setUp, so just undo the test's work
+        self.trans.rollback()
+        self.connection.close()
 
     ######################################################################
     #  H E L P E R   M E T H O D S
     ######################################################################
 
+    def _next_account(self):
+        """Returns an unused fake Account from the precomputed samples"""
+        # Faker is slow to load, so only tests that need accounts import it
+        # pylint: disable=import-outside-toplevel
+        from factory.random import reseed_random
+        from tests.factories import AccountFactory
+
+        cls = type(self)
+        if cls.sample_accounts is None:
+            # build all of the fake accounts at once so Faker runs only once
+            reseed_random("account-service")
+            cls.sample_accounts = AccountFactory.build_batch(SAMPLE_SIZE)
+        if cls.sample_accounts:
+            return cls.sample_accounts.pop()
+        return AccountFactory()
+
     def _create_accounts(self, count):
         """Factory method to create accounts in bulk"""
         accounts = []
         for _ in range(count):
-            account = AccountFactory()
+            account = self._next_account()
             response = self.client.post(BASE_URL, json=account.serialize())
             self.assertEqual(
                 response.status_code,
                 status.HTTP_201_CREATED,
                 "Could not create test Account",
             )
-            new_account = response.get_json()
+            new_account = response.json
             account.id = new_account["id"]
             accounts.append(account)
         return accounts
 
+    def _seed_accounts(self, count):
+        """Factory method to insert accounts straight into the database"""
+        # This skips the HTTP layer, not the per-row round trips: with
+        # return_defaults=True SQLAlchemy still sends one INSERT per account
+        # to fetch its primary key, and commit() only releases the SAVEPOINT
+        accounts = [self._next_account() for _ in range(count)]
+        for account in accounts:
+            account.id = None  # let the database assign the primary key
+        db.session.bulk_save_objects(accounts, return_defaults=True)
+        db.session.commit()
+        return accounts
+
+    def _assert_account_fields(self, data, account):
+        """Asserts that serialized account data matches an Account"""
+        expected = {
+            "name": account.name,
+            "email": account.email,
+            "address": account.address,
+            "phone_number": account.phone_number,
+            "date_joined": str(account.date_joined),
+        }
+        self.assertEqual({key: data[key] for key in expected}, expected)
+
     ######################################################################
     #  A C C O U N T   T E S T   C A S E S
     ######################################################################
@@ -87,17 +213,13 @@ class TestAccountService(TestCase):
         """It should be healthy"""
         resp = self.client.get("/health")
         self.assertEqual(resp.status_code, 200)
-        data = resp.get_json()
+        data = resp.json
         self.assertEqual(data["status"], "OK")
 
     def test_create_account(self):
         """It should Create a new Account"""
-        account = AccountFactory()
-        response = self.client.post(
-            BASE_URL,
-            json=account.serialize(),
-            content_type="application/json"
-        )
+        account = self._next_account()
+        response = self.client.post(BASE_URL, json=account.serialize())
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
         # Make sure location header is set
@@ -105,12 +227,8 @@ class TestAccountService(TestCase):
         self.assertIsNotNone(location)
 
         # Check the data is correct
-        new_account = response.get_json()
-        self.assertEqual(new_account["name"], account.name)
-        self.assertEqual(new_account["email"], account.email)
-        self.assertEqual(new_account["address"], account.address)
-        self.assertEqual(new_account["phone_number"], account.phone_number)
-        self.assertEqual(new_account["date_joined"], str(account.date_joined))
+        new_account = response.json
+        self._assert_account_fields(new_account, account)
 
     def test_bad_request(self):
         """It should not Create an Account when sending the wrong data"""
@@ -119,10 +237,9 @@ class TestAccountService(TestCase):
 
     def test_unsupported_media_type(self):
         """It should not Create an Account when sending the wrong media type"""
-        account = AccountFactory()
         response = self.client.post(
             BASE_URL,
-            json=account.serialize(),
+            json=SAMPLE_PAYLOAD,
             content_type="test/html"
         )
         self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
@@ -130,113 +247,68 @@ class TestAccountService(TestCase):
     # ADD YOUR TEST CASES HERE ...
     def test_list_all_accounts(self):
         """It should list all Accounts"""
-        account_a = AccountFactory()
-        account_b = AccountFactory()
+        account_a, account_b = self._seed_accounts(2)
 
-        self.client.post(
-            BASE_URL,
-            json=account_a.serialize(),
-            content_type="application/json"
-        )
-
-        self.client.post(
-            BASE_URL,
-            json=account_b.serialize(),
-            content_type="application/json"
-        )
-
-        resp = self.client.get(BASE_URL, content_type="application/json")
+        resp = self.client.get(BASE_URL)
 
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
-        data = resp.get_json()
+        data = resp.json
         self.assertEqual(len(data), 2)
         self.assertEqual(data[0]["name"], account_a.name)
         self.assertEqual(data[1]["name"], account_b.name)
 
     def test_empty_list_accounts(self):
-        resp = self.client.get(BASE_URL, content_type="application/json")
+        resp = self.client.get(BASE_URL)
 
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
-        data = resp.get_json()
+        data = resp.json
         self.assertEqual(len(data), 0)
 
     def test_read_an_account(self):
         """It should return account data"""
-        account = AccountFactory()
-        response = self.client.post(
-            BASE_URL,
-            json=account.serialize(),
-            content_type="application/json"
-        )
-        new_account = response.get_json()
+        [account] = self._seed_accounts(1)
 
-        resp = self.client.get(f"{BASE_URL}/{new_account['id']}", content_type="application/json")
+        resp = self.client.get(f"{BASE_URL}/{account.id}")
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        data = resp.get_json()
-
-        self.assertEqual(data["name"], account.name)
-        self.assertEqual(data["email"], account.email)
-        self.assertEqual(data["address"], account.address)
-        self.assertEqual(data["phone_number"], account.phone_number)
-        self.assertEqual(data["date_joined"], str(account.date_joined))
+        data = resp.json
+        self._assert_account_fields(data, account)
 
     def test_read_bad_account(self):
         """It should return a 404 error if account is non-existent"""
-        resp = self.client.patch(f"{BASE_URL}/0", content_type="application/json")
+        resp = self.client.patch(f"{BASE_URL}/0")
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_update_account(self):
         """It should update Account with new data"""
-        account = AccountFactory()
-        response = self.client.post(
-            BASE_URL,
-            json=account.serialize(),
-            content_type="application/json"
-        )
-        new_account = response.get_json()
+        [account] = self._seed_accounts(1)
 
-        account_update = AccountFactory()
+        account_update = self._next_account()
 
-        resp = self.client.patch(
-            f"{BASE_URL}/{new_account['id']}",
-            json=account_update.serialize(),
-            content_type="application/json"
-            )
+        resp = self.client.patch(f"{BASE_URL}/{account.id}", json=account_update.serialize())
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
-        data = resp.get_json()
+        data = resp.json
 
         self.assertEqual(data["email"], account_update.email)
 
     def test_update_bad_account(self):
         """It should return a 404 error if account is non-existent"""
-        account = AccountFactory()
-
-        resp = self.client.patch(f"{BASE_URL}/0", json=account.serialize(), content_type="application/json")
+        resp = self.client.patch(f"{BASE_URL}/0", json=SAMPLE_PAYLOAD)
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_delete_account(self):
-        account = AccountFactory()
-        response = self.client.post(
-            BASE_URL,
-            json=account.serialize(),
-            content_type="application/json"
-        )
-        new_account = response.get_json()
+        [account] = self._seed_accounts(1)
 
-        resp = self.client.delete(f"{BASE_URL}/{new_account['id']}", content_type="application/json")
+        resp = self.client.delete(f"{BASE_URL}/{account.id}")
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
 
-    def test_patch_not_allowed_on_base(self):
-        """It should not allow an illegal method call"""
-        resp = self.client.patch(BASE_URL)
-        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
-
-    def test_delete_not_allowed_on_base(self):
+    def test_method_not_allowed_on_base(self):
         """It should not allow an illegal method call"""
-        resp = self.client.delete(BASE_URL)
-        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        for method in ("patch", "delete"):
+            with self.subTest(method=method):
+                resp = getattr(self.client, method)(BASE_URL)
+                self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
 
     def test_security_headers(self):
         """It should return security headers"""